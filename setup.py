@@ -16,6 +16,7 @@ setup(
         'async-lru',
         'dbconn @ git+https://github.com/M3-MIIA/dbconn.git',
         'PyJWT',
+        'orjson',
         'starlette'
     ],
     classifiers=[
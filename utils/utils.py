@@ -1,12 +1,18 @@
-import os, sys, re, json, logging
+import os, sys, re, json, logging, functools, asyncio, importlib
 
 import jwt
+import orjson
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from datetime import date, datetime, time
+from time import monotonic, perf_counter_ns, time as unix_time
+from typing import Final
 from decimal import Decimal
+from uuid import UUID
 
 from fastapi import FastAPI, APIRouter, Request, HTTPException, Depends
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from mangum import Mangum
 
 from async_lru import alru_cache
@@ -22,18 +28,46 @@ from botocore.exceptions import ClientError
 
 from dbconn import DB
 
-import boto3
+# Names exported by `from utils import *`. Services have long relied on that
+# star import for both the helpers below and the modules/classes this file
+# imports, so everything that was exported before stays listed here while new
+# internal imports (orjson, UUID, ...) don't leak into consumers' namespaces.
+__all__ = [
+    # Modules and third-party names consumers get through the star import
+    "os", "sys", "re", "json", "logging", "jwt", "boto3",
+    "date", "datetime", "time", "Decimal",
+    "FastAPI", "APIRouter", "Request", "HTTPException", "Depends",
+    "JSONResponse", "Mangum", "alru_cache",
+    "text", "AsyncSession", "sessionmaker",
+    "BaseHTTPMiddleware", "CORSMiddleware", "ClientError", "DB",
+    # Configuration and constants
+    "service", "region_name", "boto3_session", "secret_manager_client",
+    "ORIGIN_SCHEME", "TENANT_DOMAIN_PRD", "TENANT_DOMAIN_HML",
+    "TENANT_REGEX_PRD", "TENANT_REGEX_HML", "IDENTIFIER_REGEX", "IS_LOCAL",
+    "INT32_MIN", "INT32_MAX", "TENANT_CACHE_SIZE", "SECRET_CACHE_TTL",
+    # Helpers
+    "ErrorResponse", "echo_request", "fetchone_to_dict", "fetchall_to_dict",
+    "to_json", "make_response", "make_error_response",
+    "get_tenant_id_from_headers", "parse_body", "handle_param_id",
+    "log_elapsed", "log_time", "a_log_time", "iam", "check_tenant",
+    "parse_event", "get_secret_key", "get_session", "JWTMiddleware", "config",
+    "set_schema",
+]
 
 service = os.environ['SERVICE_NAME']
 region_name = os.environ['DEPLOY_AWS_REGION']
 
-# Create a Secrets Manager client
-boto3_session = boto3.session.Session()
-secret_manager_client = boto3_session.client(service_name="secretsmanager", region_name=region_name)
+ORIGIN_SCHEME = "https://"
+TENANT_DOMAIN_PRD = ".miia.tech"
+TENANT_DOMAIN_HML = "--m3par-miia.netlify.app"
 
+# No longer used by get_tenant_id_from_headers; kept unchanged for code that
+# imports them from utils.
 TENANT_REGEX_PRD = re.compile(r"https://(?P<tenant>.+).miia.tech")
 TENANT_REGEX_HML = re.compile(r"https://.*--m3par-miia.netlify.app")
 
+IDENTIFIER_REGEX: Final = re.compile(r"[A-Za-z0-9_]+")
+
 IS_LOCAL = os.environ.get("ENVIRONMENT") == "local"
 
 class ErrorResponse(RuntimeError):
@@ -57,42 +91,49 @@ def echo_request(event):
 
 
 def fetchone_to_dict(result):
-    col_names = result.keys()
-    row = result.fetchone()
-    return dict(zip(col_names, row)) if row else None
+    row = result.mappings().fetchone()
+    return dict(row) if row else None
 
 
 def fetchall_to_dict(result):
-    col_names = result.keys()
-    data = result.fetchall()
-    return [dict(zip(col_names, row)) for row in data]
+    return [dict(row) for row in result.mappings()]
 
 
 def to_json(obj):
-    if isinstance(obj, (date, datetime, time)):
-        return obj.isoformat()
+    # orjson serializes dates and UUIDs itself and only falls back here for
+    # other types, Decimal being the common one, so check it first.
     if isinstance(obj, Decimal):
         return float(obj)
+    if isinstance(obj, (date, time)):
+        return obj.isoformat()
+    if isinstance(obj, UUID):
+        return str(obj)
 
     raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
 
-def make_response(status_code, body=None):
-    headers = {"Access-Control-Allow-Origin": "*"}
+_RESPONSE_HEADERS = {"Access-Control-Allow-Origin": "*"}
+_JSON_RESPONSE_HEADERS = {**_RESPONSE_HEADERS, "Content-Type": "application/json"}
 
-    response = {"statusCode": status_code, "headers": headers}
 
-    if body:
-        headers["Content-Type"] = "application/json"
-        response["body"] = json.dumps(body, default=to_json)
+def make_response(status_code, body=None):
+    # The header templates are copied since callers may add their own headers
+    if not body:
+        return {"statusCode": status_code, "headers": _RESPONSE_HEADERS.copy()}
 
-    return response
+    return {
+        "statusCode": status_code,
+        "headers": _JSON_RESPONSE_HEADERS.copy(),
+        "body": orjson.dumps(
+            body, default=to_json, option=orjson.OPT_NON_STR_KEYS
+        ).decode(),
+    }
 
 
 def make_error_response(
     status_code,
     message,
-    extra_fields={},
+    extra_fields: dict = None,
     *,
     error_code: str = None,
     details: str = None,
@@ -102,14 +143,16 @@ def make_error_response(
     errors (return the error in a 'message' field).
     """
 
-    extra_fields = extra_fields.copy()
+    body = {"message": message}
 
+    if extra_fields:
+        body.update(extra_fields)
     if error_code is not None:
-        extra_fields["error_code"] = error_code
+        body["error_code"] = error_code
     if details is not None:
-        extra_fields["details"] = details
+        body["details"] = details
 
-    return make_response(status_code, {"message": message, **extra_fields})
+    return make_response(status_code, body)
 
 
 def get_tenant_id_from_headers(
@@ -134,18 +177,34 @@ def get_tenant_id_from_headers(
     if origin is None:
         return None, make_error_response(400, "Missing origin header")
 
-    match = TENANT_REGEX_PRD.match(origin)
-    if match:
-        tenant_id = match.group("tenant")
-        return tenant_id, None
+    tenant_id = _get_tenant_id_from_origin(origin)
+    if tenant_id is None:
+        return None, make_error_response(400, "Invalid url")
+
+    return tenant_id, None
+
+
+@functools.lru_cache(maxsize=1024)
+def _get_tenant_id_from_origin(origin: str) -> str | None:
+    # Only the resolved tenant ID is cached, never a response dict, since
+    # callers may mutate the responses they get back.
+
+    host = origin[len(ORIGIN_SCHEME):] if origin.startswith(ORIGIN_SCHEME) else ""
 
-    match = TENANT_REGEX_HML.match(origin)
-    if match:
-        # Assume test deploys that don't send the X-Tenant-Id header as
-        # belonging to the portal tenant.
-        return "portal", None
+    # An Origin is just scheme://host, so reject anything carrying a path
+    if host and "/" not in host:
+        if host.endswith(TENANT_DOMAIN_PRD):
+            tenant_id = host[:-len(TENANT_DOMAIN_PRD)]
+            # The tenant must be a single label directly under the domain
+            if tenant_id and "." not in tenant_id:
+                return tenant_id
 
-    return None, make_error_response(400, "Invalid url")
+        if host.endswith(TENANT_DOMAIN_HML):
+            # Assume test deploys that don't send the X-Tenant-Id header as
+            # belonging to the portal tenant.
+            return "portal"
+
+    return None
 
 
 def parse_body(body):
@@ -153,115 +212,280 @@ def parse_body(body):
         raise HTTPException(400, "Missing request body")
 
     try:
-        body = json.loads(body)
+        body = orjson.loads(body)
         return body
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logging.error(str(e))
         raise HTTPException(400, detail={"message":"Invalid request body format","error_code":"bad_request_body_format"})
 
 
+# Range of a Postgres INTEGER column
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
+
+
 def handle_param_id(param_id, param_name='param'):
     # For INTERGER parameters
 
     if not param_id:
         raise HTTPException(400, f"Missing {param_name}")
+    if isinstance(param_id, str):
+        # Reject malformed input up front instead of letting int() raise.
+        digits = param_id[1:] if param_id[0] in "+-" else param_id
+        if not (digits.isascii() and digits.isdigit()):
+            raise HTTPException(400, f"Invalid {param_name} format")
     try:
         param_id = int(param_id)
     except ValueError:
         raise HTTPException(400, f"Invalid {param_name} format")
-    if param_id.bit_length() > 32:
+    if not INT32_MIN <= param_id <= INT32_MAX:
         raise HTTPException(400, f"Invalid {param_name}")
 
     return param_id
 
 
-def log_time(label: str, func):
-    from time import time
+@contextmanager
+def log_elapsed(label: str):
+    """
+    Log the wall time spent inside the `with` block at INFO level.
 
-    start = time()
-    ret = func()
-    end = time()
+    Nothing is measured when INFO is disabled, and nothing is logged if the
+    block raises.
+    """
 
-    logging.info(f"{label}: {end - start:.1f}s")
-    return ret
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        yield
+        return
 
+    start = perf_counter_ns()
+    yield
+    logging.info("%s: %.1fs", label, (perf_counter_ns() - start) / 1e9)
 
-async def a_log_time(label: str, func):
-    from time import time
 
-    start = time()
-    ret = await func()
-    end = time()
+def log_time(label: str, func):
+    with log_elapsed(label):
+        return func()
+
 
-    logging.info(f"{label}: {end - start:.1f}s")
-    return ret
+async def a_log_time(label: str, func):
+    with log_elapsed(label):
+        return await func()
 
 
 def iam(event):
-    http_headers = {k.lower(): v for k, v in event["headers"].items()}
-
-    api_token = http_headers.get("x-api-key")
+    api_token = next(
+        (v for k, v in event["headers"].items() if k.lower() == "x-api-key"),
+        None,
+    )
     if not api_token:
         raise HTTPException(400, "Must pass an API Key")
 
-    try:
-        tenant_code, _api_key = api_token.split("-")
-    except ValueError:
+    tenant_code, sep, _api_key = api_token.partition("-")
+    if not sep:
         raise HTTPException(400, "Invalid API Key format")
 
     return tenant_code
 
 
-@alru_cache
+_TENANT_UPSERT = text("""
+    INSERT INTO tenant (code)
+    VALUES (:tenant_code)
+    ON CONFLICT (code) DO UPDATE
+    SET code = EXCLUDED.code
+    RETURNING id
+""")
+
+
+# Tenant codes come straight from the client's API key, so bound the cache
+# (as alru_cache did) instead of keeping every code ever seen.
+TENANT_CACHE_SIZE = 128
+
+_tenant_cache: OrderedDict[str, dict] = OrderedDict()
+# tenant_code -> [lock, number of lookups holding or waiting on it]
+_tenant_locks: dict[str, list] = {}
+
+
 async def check_tenant(tenant_code, DB):
-    sql = """
-        INSERT INTO tenant (code)
-        VALUES (:tenant_code)
-        ON CONFLICT (code) DO UPDATE 
-        SET code = EXCLUDED.code
-        RETURNING id
-    """
+    tenant = _tenant_cache.get(tenant_code)
+    if tenant is not None:
+        _tenant_cache.move_to_end(tenant_code)
+        return tenant
 
-    async with DB.begin() as conn:
-        result = await conn.execute(text(sql), {"tenant_code": tenant_code})
-        return fetchone_to_dict(result)
+    # Serialize the first lookups of a tenant so only one of them hits the DB
+    entry = _tenant_locks.get(tenant_code)
+    if entry is None:
+        entry = _tenant_locks[tenant_code] = [asyncio.Lock(), 0]
+    entry[1] += 1
+
+    try:
+        async with entry[0]:
+            tenant = _tenant_cache.get(tenant_code)
+            if tenant is not None:
+                return tenant
+
+            async with DB.begin() as conn:
+                result = await conn.execute(_TENANT_UPSERT, {"tenant_code": tenant_code})
+                tenant = fetchone_to_dict(result)
+
+            _tenant_cache[tenant_code] = tenant
+            if len(_tenant_cache) > TENANT_CACHE_SIZE:
+                _tenant_cache.popitem(last=False)
+    finally:
+        # Drop the lock only once no other lookup holds or waits on it, so
+        # concurrent callers always share the same one, even after a failure.
+        entry[1] -= 1
+        if not entry[1]:
+            del _tenant_locks[tenant_code]
+
+    return tenant
 
 
 async def parse_event(request):
     if IS_LOCAL:
+        # Starlette's Headers is already a case-insensitive read-only mapping
+        # and path_params is a plain dict, so pass them through uncopied.
         return {
-            "headers": dict(request.headers),
+            "headers": request.headers,
             "body": await request.body(),
             "queryStringParameters": dict(request.query_params),
-            "pathParameters": dict(request.path_params),
+            "pathParameters": request.path_params,
             "httpMethod": request.method,
             "resource": request.scope.get('path')
         }
     return request.scope["aws.event"]
 
 
+# Secrets are re-fetched after this many seconds so rotations are picked up
+SECRET_CACHE_TTL = 15 * 60
+
+
+def _ttl_cache(ttl: float, maxsize: int = 32):
+    """
+    Memoize a function on its positional arguments for `ttl` seconds, keeping
+    at most `maxsize` entries. Keyword arguments are passed through but are not
+    part of the key. Exceptions are not cached.
+    """
+
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            now = monotonic()
+            hit = cache.get(args)
+            if hit is not None and hit[1] > now:
+                return hit[0]
+
+            value = func(*args, **kwargs)
+
+            # Sweep expired entries on insert, then drop the oldest ones while
+            # over the limit (dicts keep insertion order).
+            for key in [key for key, (_, expires) in cache.items() if expires <= now]:
+                del cache[key]
+            cache.pop(args, None)
+            while len(cache) >= maxsize:
+                del cache[next(iter(cache))]
+
+            cache[args] = (value, now + ttl)
+            return value
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+@_ttl_cache(SECRET_CACHE_TTL)
+def _get_secret_dict(secret_name, *, aws_client):
+    # Cached per secret rather than per key, so reading several keys of the
+    # same secret costs a single API call and JSON parse. The client is not
+    # part of the key, so callers creating one per request still share entries.
+    # Errors propagate and are not cached.
+    return orjson.loads(aws_client.get_secret_value(SecretId=secret_name)["SecretString"])
+
+
 def get_secret_key(aws_client, secret_name, key_name):
+    # Passing None uses the module's lazily created Secrets Manager client
+    if aws_client is None:
+        aws_client = _get_secret_manager_client()
+
     try:
-        return json.loads(aws_client.get_secret_value(SecretId=secret_name)["SecretString"]).get(key_name)
+        secret = _get_secret_dict(secret_name, aws_client=aws_client)
     except ClientError as e:
-        logging.error(f"Erro ao obter o valor do secreto {secret_name}: {e}")
+        logging.error("Erro ao obter o valor do secreto %s: %s", secret_name, e)
         return
 
+    return secret.get(key_name)
+
+
+_async_session = sessionmaker(
+    bind=DB,
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
+
 async def get_session():
-    async_session = sessionmaker(
-            bind=DB,
-            class_=AsyncSession,
-            expire_on_commit=False,
-        )
-    async with async_session() as session:
+    async with _async_session() as session:
         yield session
 
+@functools.cache
+def _get_boto3_session():
+    import boto3
+
+    return boto3.session.Session()
+
+
+@functools.cache
+def _get_secret_manager_client():
+    # Created on first use so handlers that never read secrets don't pay for
+    # the boto3/botocore imports and client construction on cold start.
+    from botocore.config import Config
+
+    # Keep connections to Secrets Manager alive across warm invocations and
+    # fail fast instead of hanging on botocore's 60s defaults.
+    config = Config(
+        tcp_keepalive=True,
+        max_pool_connections=10,
+        connect_timeout=2,
+        read_timeout=5,
+        retries={"max_attempts": 3, "mode": "standard"},
+    )
+
+    return _get_boto3_session().client(
+        service_name="secretsmanager",
+        region_name=region_name,
+        config=config,
+    )
+
+
+class _LazyProxy:
+    """
+    Stand-in for an object that is only built, by `factory`, on first
+    attribute access.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+
+# Former module-level names, kept so `from utils import *` consumers still get
+# them, without importing boto3 or building the client at import time.
+boto3 = _LazyProxy(lambda: importlib.import_module("boto3"))
+boto3_session = _LazyProxy(_get_boto3_session)
+secret_manager_client = _LazyProxy(_get_secret_manager_client)
+
+
+@_ttl_cache(SECRET_CACHE_TTL)
 def _get_secret():
 
     secret_name = f"{service}/jwt-access-key"
 
     try:
-        get_secret_value_response = secret_manager_client.get_secret_value(SecretId=secret_name)
+        get_secret_value_response = _get_secret_manager_client().get_secret_value(SecretId=secret_name)
     except ClientError as e:
         # For a list of exceptions thrown, see
         # https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_GetSecretValue.html
@@ -272,37 +496,73 @@ def _get_secret():
     if not secret:
         raise ValueError
 
-    return json.loads(secret)
+    return orjson.loads(secret)
+
+# JWTMiddleware rejections have fixed bodies, so serialize them only once
+_JWT_EXPIRED_BODY = orjson.dumps({"detail": "Token expired"})
+_JWT_INVALID_BODY = orjson.dumps({"detail": "Invalid token"})
+_JWT_MISSING_BODY = orjson.dumps({"detail": "Missing Authorization Credentials"})
+
+
+@functools.lru_cache(maxsize=4096)
+def _decode_jwt(token: bytes, key: bytes, algorithm: str) -> tuple:
+    # Only successfully verified tokens end up cached; the caller re-checks
+    # `exp` on every hit since the cache outlives the token. PyJWT accepts any
+    # `exp` that int() can convert (e.g. "99999999999"), so normalize it the same
+    # way once here instead of comparing the raw claim.
+    payload = jwt.decode(token, key, algorithms=[algorithm])
+    exp = payload.get("exp")
+    return payload, None if exp is None else int(exp)
+
+
+class JWTMiddleware:
+    """
+    Pure ASGI middleware that validates the `Authorization: Bearer <token>`
+    header and exposes the decoded payload as `request.state.user`.
+    """
 
-class JWTMiddleware(BaseHTTPMiddleware):
     def __init__(self, app, secret_key: str, algorithm: str = "HS256"):
-        super().__init__(app)
+        self.app = app
         self.secret_key = secret_key
         self.algorithm = algorithm
-
-    async def dispatch(self, request: Request, call_next):
-        token = request.headers.get("Authorization")
-        if token:
+        self._key = secret_key.encode() if isinstance(secret_key, str) else secret_key
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        # ASGI header names are lowercase bytes
+        auth = next((v for k, v in scope["headers"] if k == b"authorization"), None)
+        if auth:
+            # Remove 'Bearer' prefix; PyJWT accepts the token as bytes. A header
+            # without a token yields b"" and is rejected as an invalid token.
+            _scheme, _, token = auth.partition(b" ")
             try:
-                token = token.split(" ")[1]  # Remove 'Bearer' prefix
-                payload = jwt.decode(token, self.secret_key, algorithms=[self.algorithm])
-                request.state.user = payload  # Adiciona o payload ao estado da requisição
+                payload, exp = _decode_jwt(token, self._key, self.algorithm)
+                if exp is not None and exp <= unix_time():
+                    raise jwt.ExpiredSignatureError("Signature has expired")
             except jwt.ExpiredSignatureError:
-                return JSONResponse(status_code=401, content={"detail": "Token expired"})
+                body = _JWT_EXPIRED_BODY
             except jwt.InvalidTokenError:
-                return JSONResponse(status_code=401, content={"detail": "Invalid token"})
+                body = _JWT_INVALID_BODY
+            else:
+                # Adiciona o payload ao estado da requisição
+                # (copied, as the cached payload is shared between requests)
+                scope.setdefault("state", {})["user"] = dict(payload)
+                await self.app(scope, receive, send)
+                return
         else:
-            return JSONResponse(status_code=401, content={"detail": "Missing Authorization Credentials"})
+            body = _JWT_MISSING_BODY
 
-        response = await call_next(request)
-        return response
-   
+        response = Response(body, status_code=401, media_type="application/json")
+        await response(scope, receive, send)
 
 
 def config(file=__file__,jwt_auth=False):
 
     if not IS_LOCAL:
-        router = FastAPI()  
+        router = FastAPI()
         if jwt_auth:
             ACCESS_TOKEN_SECRET_KEY = _get_secret()["ACCESS_TOKEN_SECRET_KEY"]
             router.add_middleware(JWTMiddleware, secret_key=ACCESS_TOKEN_SECRET_KEY)
@@ -323,8 +583,18 @@ def config(file=__file__,jwt_auth=False):
     return router, lambda_handler, Request, parent_dir
 
 
+@functools.lru_cache(maxsize=256)
+def _search_path_stmt(tenant_id):
+    if tenant_id == 'portal':
+        return text("SET search_path TO public")
+
+    # Schema names can't be bound as parameters, so make sure the tenant ID
+    # is a plain identifier before interpolating it into the SQL.
+    if not IDENTIFIER_REGEX.fullmatch(str(tenant_id)):
+        raise HTTPException(400, "Invalid tenant")
+
+    return text(f"SET search_path TO tenant_{tenant_id}")
+
+
 async def set_schema(tenant_id, session):
-    if tenant_id == 'portal': 
-        await session.execute(text("SET search_path TO public"))
-    else:
-        await session.execute(text(f"SET search_path TO tenant_{tenant_id}"))
\ No newline at end of file
+    await session.execute(_search_path_stmt(tenant_id))